@@ -12,12 +12,11 @@ import os
 import json
 import logging
 import datetime
+import itertools
 import time
-import ast
 import re
 from threading import Event
-from queue import Queue
-from threading import Thread, Condition
+from threading import Thread, Semaphore
 
 from fledge.common import logger
 from fledge.plugins.common import utils
@@ -149,11 +148,24 @@ _LOGGER = logger.setup(__name__, level=logging.INFO)
 producer = None
 consumer = None
 bucket = None
-condition = None
 BUCKET_SIZE = 1
+_PUBLISH_INTERVAL = 0.02
+_RING_WAIT_TIMEOUT = 0.1
+_RESYNC_LAG = 0.1
 wait_event = Event()
 c_callback = None
 c_ingest_ref = None
+# First characters a numeric value can start with; anything else is kept as a string without running the patterns
+_NUMERIC_LEAD = frozenset('+-.0123456789')
+_INT_RE = re.compile(r'^[-+]?[0-9]+$')
+_FLOAT_RE = re.compile(r'^[-+]?(?:[0-9]+\.?[0-9]*|\.[0-9]+)(?:[eE][-+]?[0-9]+)?$')
+# Timestamp formats which can be parsed by a precompiled pattern instead of datetime.strptime
+_FAST_TS_FORMATS = {
+    '%Y-%m-%d %H:%M:%S.%f': re.compile(r'(\d{4})-(\d{2})-(\d{2}) (\d{2}):(\d{2}):(\d{2})\.(\d{1,6})').fullmatch,
+    '%Y-%m-%dT%H:%M:%S.%f': re.compile(r'(\d{4})-(\d{2})-(\d{2})T(\d{2}):(\d{2}):(\d{2})\.(\d{1,6})').fullmatch,
+    '%Y-%m-%d %H:%M:%S': re.compile(r'(\d{4})-(\d{2})-(\d{2}) (\d{2}):(\d{2}):(\d{2})()').fullmatch,
+    '%Y-%m-%dT%H:%M:%S': re.compile(r'(\d{4})-(\d{2})-(\d{2})T(\d{2}):(\d{2}):(\d{2})()').fullmatch,
+}
 
 
 def plugin_info():
@@ -221,17 +233,22 @@ def plugin_start(handle):
     Returns:
         a playback reading in a JSON document, as a Python dict
     """
-    global producer, consumer, bucket, condition, BUCKET_SIZE, wait_event
-
-    if handle['timestampFromFile']['value'] == 'false':
+    global producer, consumer, bucket, BUCKET_SIZE, wait_event
+
+    # The ring only bounds how far the producer may run ahead of the consumer; batching is decided by the
+    # producer. Room for a second's worth of items, readings or whole bursts, keeps the two threads from running
+    # in lock step.
+    if handle['ingestMode']['value'] == 'burst':
+        BUCKET_SIZE = max(1, 1000 // int(handle['burstInterval']['value']))
+    else:
         BUCKET_SIZE = int(handle['sampleRate']['value'])
 
-    condition = Condition()
-    bucket = Queue(BUCKET_SIZE)
-    producer = Producer(bucket, condition, handle)
-    consumer = Consumer(bucket, condition, handle)
-
-    wait_event.clear()
+    # Each start gets its own stop event, so threads left over from a previous start that did not stop in
+    # time are never woken up again by this one
+    wait_event = Event()
+    bucket = SPSCRing(BUCKET_SIZE, wait_event)
+    producer = Producer(bucket, handle, wait_event)
+    consumer = Consumer(bucket, handle, wait_event)
 
     producer.start()
     consumer.start()
@@ -264,21 +281,20 @@ def plugin_shutdown(handle):
     Returns:
         plugin shutdown
     """
-    global producer, consumer, wait_event, bucket, condition
+    global producer, consumer, wait_event, bucket
 
     wait_event.set()
-    if producer is not None:
-        producer._tstate_lock = None
-        producer._stop()
-        producer = None
-    if consumer is not None:
-        consumer._tstate_lock = None
-        consumer._stop()
-        consumer = None
     if bucket is not None:
-        bucket.unfinished_tasks = 0
-        bucket = None
-    condition = None
+        # Wake the consumer if it is blocked waiting for published readings
+        bucket.published.release()
+    for thread in (producer, consumer):
+        if thread is not None:
+            thread.join(timeout=5)
+            if thread.is_alive():
+                _LOGGER.warning("{} thread did not stop within 5 seconds".format(thread.name))
+    producer = None
+    consumer = None
+    bucket = None
     _LOGGER.info('playback plugin shut down.')
 
 
@@ -295,12 +311,81 @@ def plugin_register_ingest(handle, callback, ingest_ref):
     c_ingest_ref = ingest_ref
 
 
+def _timestamp_parser(ts_format):
+    """ Returns a function converting a timestamp string in the given format to a datetime.
+
+    Common ISO like formats are parsed with a precompiled pattern; anything the pattern does not accept, and
+    any other format, is left to datetime.strptime.
+    """
+    fast_match = _FAST_TS_FORMATS.get(ts_format)
+    if fast_match is None:
+        return lambda value: datetime.datetime.strptime(value, ts_format)
+
+    def parse(value):
+        m = fast_match(value)
+        if m is None:
+            return datetime.datetime.strptime(value, ts_format)
+        year, month, day, hour, minute, second, fraction = m.groups()
+        return datetime.datetime(int(year), int(month), int(day), int(hour), int(minute), int(second),
+                                 int(fraction.ljust(6, '0')) if fraction else 0)
+    return parse
+
+
+class SPSCRing(object):
+    """ Bounded ring buffer shared by exactly one producer and one consumer thread.
+
+    Only the producer advances tail and only the consumer advances head, so with the GIL making the int
+    stores atomic no lock is needed to hand readings over. Items put by the producer become visible to the
+    consumer in batches, when publish() moves tail up to the producer's write cursor. Each publish releases
+    the published semaphore, which the consumer blocks on instead of polling; the free semaphore counts the
+    slots drain() has handed back, which a producer facing a full ring blocks on.
+    """
+    def __init__(self, capacity, stop_event):
+        self.capacity = capacity
+        self.buf = [None] * capacity
+        self.head = 0
+        self.tail = 0
+        self._next = 0
+        self.published = Semaphore(0)
+        self._free = Semaphore(capacity)
+        self._stop_event = stop_event
+
+    def put(self, item):
+        if not self._free.acquire(blocking=False):
+            # Let the consumer see what is pending, then wait for it to free a slot or for shutdown
+            self.publish()
+            while not self._free.acquire(timeout=_RING_WAIT_TIMEOUT):
+                if self._stop_event.is_set():
+                    return False
+        self.buf[self._next % self.capacity] = item
+        self._next += 1
+        return True
+
+    def publish(self):
+        if self.tail != self._next:
+            self.tail = self._next
+            self.published.release()
+
+    def drain(self):
+        head = self.head
+        tail = self.tail
+        items = []
+        for seq in range(head, tail):
+            idx = seq % self.capacity
+            items.append(self.buf[idx])
+            self.buf[idx] = None
+        self.head = tail
+        for _ in items:
+            self._free.release()
+        return items
+
+
 class Producer(Thread):
-    def __init__(self, queue, cond, handle):
-        super(Producer, self).__init__()
-        self.queue = queue
-        self.condition = cond
+    def __init__(self, ring, handle, stop_event):
+        super(Producer, self).__init__(name='playback-producer')
+        self.ring = ring
         self.handle = handle
+        self.stop_event = stop_event
 
         try:
             if self.handle['ingestMode']['value'] == 'burst':
@@ -315,11 +400,13 @@ class Producer(Thread):
 
         self.csv_file_name = "{}/{}".format(_FLEDGE_DATA, self.handle['csvFilename']['value'])
         self.has_header = True if self.handle['headerRow']['value'] == 'true' else False
-        with open(self.csv_file_name, 'r') as data_file:
-            headr = data_file.readline()
-            headr = headr.strip().replace('\n', '').replace('\r', '').replace(' ', '')
-            self.field_names = headr.split(',') if self.has_header else \
-                None if self.handle['fieldNames']['value'] == 'None' else self.handle['fieldNames']['value'].split(",")
+        self.field_names = None if self.has_header or self.handle['fieldNames']['value'] == 'None' else \
+            self.handle['fieldNames']['value'].split(",")
+
+        # The whole file is parsed once up front, taking the column names from its first row where needed,
+        # so a repeatLoop rewind never re-reads it
+        rows = self._load_all()
+        self._idx = 0
 
         # Cherry pick columns from readings and if desired, with
         rc = self.handle['readingCols']['value']
@@ -327,53 +414,110 @@ class Producer(Thread):
         if self.handle['historicTimestamps']['value'] == 'false' and self.handle['timestampFromFile']['value'] == 'true':
             self.exclude_ts_column_from_reading_columns()
 
-        self.iter_sensor_data = iter(self.get_data())
-
         self.prv_readings_ts = None
         self.timestamp_interval = None
 
+        # Resolve the configuration used by run() once, rather than on every row
+        self._is_burst = self.handle['ingestMode']['value'] == 'burst'
+        self._burst_size = int(self.handle['burstSize']['value'])
+        self._is_historic = self.handle['historicTimestamps']['value'] == 'true'
+        self._is_ts_file = self.handle['timestampFromFile']['value'] == 'true'
+        self._is_repeat = self.handle['repeatLoop']['value'] == 'true'
+        self._ts_col = self.handle['timestampCol']['value']
+        self._ts_format = self.handle['timestampFormat']['value']
+        self._parse_ts = _timestamp_parser(self._ts_format)
+        # (source column, reading name) pairs to cherry pick
+        self._proj = tuple(self.reading_cols.items())
+        # Readings paced by the timestamps in the file may be far apart, so those are published one by one;
+        # otherwise publish to the consumer roughly every _PUBLISH_INTERVAL worth of readings
+        self._is_paced_by_file = self._is_ts_file and not self._is_historic and not self._is_burst
+        if self._is_paced_by_file:
+            self._publish_every = 1
+        else:
+            self._publish_every = max(1, min(self.ring.capacity, int(_PUBLISH_INTERVAL / self.period)))
+        # How far run() may fall behind its deadlines before it gives up catching up
+        self._max_lag = max(_RESYNC_LAG, self.period)
+
+        # Everything run() would otherwise work out per row depends only on the file and the configuration, so
+        # the column projection and the delay before each reading are resolved here, once for the whole file
+        self._rows = self._project_rows(rows)
+        if not self._is_burst:
+            delays = self._row_delays(rows) if self._is_paced_by_file else itertools.repeat(self.period)
+            pairs = list(zip(self._rows, delays))
+            # Batch mode iterates the prepared rows, cycling over them with repeatLoop so that reaching the end of
+            # the file costs nothing; burst mode slices them by index instead
+            if self._is_repeat and pairs:
+                # On every later pass the first row follows the last one a sample period later, not at once
+                looped = [(pairs[0][0], self.period)] + pairs[1:]
+                self.iter_sensor_data = itertools.chain(pairs, itertools.cycle(looped))
+            else:
+                self.iter_sensor_data = iter(pairs)
+
     def exclude_ts_column_from_reading_columns(self):
         ts_col = self.handle['timestampCol']['value']
         new_reading_cols = self.reading_cols.copy()
         if len(self.reading_cols) > 0:
             for k, v in self.reading_cols.items():
                 if ts_col != k:
-                    new_reading_cols.update({k: v})
+                    new_reading_cols[k] = v
         else:
             for i in self.field_names:
                 if ts_col != i:
-                    new_reading_cols.update({i: i})
+                    new_reading_cols[i] = i
         self.reading_cols = new_reading_cols.copy()
 
-    def get_data(self):
-        with open(self.csv_file_name, 'r') as data_file:
-            reader = csv.DictReader(data_file, fieldnames=self.field_names)
-            # Skip Header
-            if self.has_header:
-                next(reader)
-            regex = re.compile('[ `~!@#$%^&*()_=}{\]\[|;:"<>,?/\\\'ABCDFGHIJKLMNOPQRSTUVWXYZabcdfghijklmnopqrstuvwxyz]')
-            regex_num = re.compile('[+-0123456789]')
-            regex_float = re.compile('[.eE]')
-            for line in reader:
-                new_line = {}
-                for k, v in line.items():
-                    try:
-                        contains_numbers = regex_num.search(v) is not None
-                        contains_float = regex_float.search(v) is not None
-                        contains_string = regex.search(v) is not None
-                        if contains_string:
-                            nv = v
-                        elif contains_numbers:
-                            if contains_float:
-                                nv = float(v) if isinstance(ast.literal_eval(v), float) else v
-                            else:
-                                nv = int(v) if isinstance(ast.literal_eval(v), int) else v
-                        else:
-                            nv = v
-                    except ValueError:
-                        nv = v
-                    new_line.update({k: nv})
-                yield new_line
+    def get_data(self, reader):
+        # Plain csv.reader hands back each row as a list built in C; the reading dict is then assembled
+        # in one go instead of letting DictReader construct an intermediate dict per row.
+        field_names = self.field_names
+        for line in reader:
+            if not line:
+                continue
+            values = []
+            for v in line:
+                if v[:1] not in _NUMERIC_LEAD:
+                    values.append(v)
+                elif _INT_RE.match(v):
+                    values.append(int(v))
+                elif _FLOAT_RE.match(v):
+                    values.append(float(v))
+                else:
+                    values.append(v)
+            yield dict(zip(field_names, values))
+
+    def _load_all(self):
+        # newline='' leaves line endings to the csv module, and a 1 MiB buffer cuts down read() calls on big files
+        with open(self.csv_file_name, 'r', buffering=1048576, newline='') as data_file:
+            reader = csv.reader(data_file)
+            # Take the column names from the header row, or from the first row if none were configured
+            if self.has_header or self.field_names is None:
+                header = next(reader, None) or []
+                self.field_names = [c.strip().replace(' ', '') for c in header]
+            return list(self.get_data(reader))
+
+    def _project_rows(self, rows):
+        # If we need to cherry pick cols, and possibly with a different name
+        if self._proj:
+            return [{v: readings[k] for k, v in self._proj if k in readings} for readings in rows]
+        return rows
+
+    def _row_delays(self, rows):
+        delays = []
+        next_iteration_secs = self.period
+        for readings in rows:
+            try:
+                next_iteration_secs = self.get_time_stamp_diff(readings)
+            except Exception as ex:
+                _LOGGER.warning("playback producer exception: {}".format(str(ex)))
+            delays.append(next_iteration_secs)
+        return delays
+
+    def _next_burst(self):
+        # Take the rows for a whole burst with one list slice; fewer than burstSize rows means EOF was reached
+        start = self._idx
+        rows = self._rows[start:start + self._burst_size]
+        self._idx = start + len(rows)
+        return rows
 
     def get_time_stamp_diff(self, readings):
         # The option to have the timestamp come from a column in the CSV file. The first timestamp should
@@ -384,9 +528,7 @@ class Producer(Thread):
         # difference between the rows.
         c = 0
         try:
-            ts_col = self.handle['timestampCol']['value']
-            ts_format = self.handle['timestampFormat']['value']
-            readings_ts = datetime.datetime.strptime(readings[ts_col], ts_format)
+            readings_ts = self._parse_ts(readings[self._ts_col])
             if self.prv_readings_ts is not None:
                 c = readings_ts - self.prv_readings_ts
                 c = c.total_seconds()
@@ -397,107 +539,101 @@ class Producer(Thread):
 
     def run(self):
         eof_reached = False
-        while True:
-            time_start = time.time()
+        pending = 0
+        next_iteration_secs = self.period
+        # Pace against absolute deadlines on the monotonic clock so that time spent producing a reading, or a
+        # wall clock adjustment, does not accumulate as drift
+        deadline = time.monotonic()
+        while not self.stop_event.is_set():
             sensor_data = {}
             try:
-                if self.handle['ingestMode']['value'] == 'burst':
+                if self._is_burst:
                     # Support for burst of data. Allow a burst size to be defined in the configuration, default 1.
                     # If a size of greater than 1 is set then that number of input values should be sent as an
                     # array of value. E.g. with a burst size of 10, which data point in the reading will be an
                     # array of 10 elements.
-                    burst_data_points = []
-                    for i in range(int(self.handle['burstSize']['value'])):
-                        readings = next(self.iter_sensor_data)
-                        # If we need to cherry pick cols, and possibly with a different name
-                        if len(self.reading_cols) > 0:
-                            new_dict = {}
-                            for k, v in self.reading_cols.items():
-                                if k in readings:
-                                    new_dict.update({v: readings[k]})
-                            burst_data_points.append(new_dict)
-                        else:
-                            burst_data_points.append(readings)
-                    sensor_data.update({"data": burst_data_points})
                     next_iteration_secs = self.period
+                    burst_data_points = self._next_burst()
+                    if burst_data_points:
+                        sensor_data["data"] = burst_data_points
+                    if len(burst_data_points) < self._burst_size:
+                        # A short burst is the last one in the file
+                        _LOGGER.warning("playback - EOF reached")
+                        eof_reached = True
                 else:
-                    readings = next(self.iter_sensor_data)
-                    # If we need to cherry pick cols, and possibly with a different name
-                    if len(self.reading_cols) > 0:
-                        for k, v in self.reading_cols.items():
-                            if k in readings:
-                                sensor_data.update({v: readings[k]})
-                    else:
-                        sensor_data.update(readings)
-                    if self.handle['historicTimestamps']['value'] == 'true':
-                        next_iteration_secs = self.period
-                    elif self.handle['timestampFromFile']['value'] == 'true':
-                        next_iteration_secs = self.get_time_stamp_diff(readings)
-                    else:
-                        next_iteration_secs = self.period
-            except StopIteration as ex:
-                _LOGGER.warning("playback - EOF reached: {}".format(str(ex)))
+                    readings, next_iteration_secs = next(self.iter_sensor_data)
+                    # The consumer pops the timestamp column off historic readings, so don't hand it the cached row
+                    sensor_data = dict(readings) if self._is_historic else readings
+            except StopIteration:
+                _LOGGER.warning("playback - EOF reached")
                 eof_reached = True
-                if self.handle['ingestMode']['value'] == 'burst':
-                    if len(burst_data_points) > 0:
-                        sensor_data.update({"data": burst_data_points})
             except Exception as ex:
                 _LOGGER.warning("playback producer exception: {}".format(str(ex)))
 
-            wait_event.wait(timeout=next_iteration_secs - (time.time()-time_start))
+            deadline += max(next_iteration_secs, 0)
+            now = time.monotonic()
+            if now - deadline > self._max_lag:
+                # Only a real stall, e.g. on a full ring, puts the producer this far behind; resume pacing from
+                # now rather than sending the whole backlog at once. Ordinary wake-up lateness stays below it and
+                # is caught up on the next deadlines.
+                deadline = now
+            delay = deadline - now
+            if delay > 0:
+                self.stop_event.wait(timeout=delay)
             time_stamp = utils.local_timestamp()
 
-            if not self.condition._is_owned():
-                self.condition.acquire()
             if len(sensor_data) > 0:
                 value = {'data': sensor_data, 'ts': time_stamp}
-                self.queue.put(value)
-            if self.queue.full() or eof_reached:
-                self.condition.notify()
-                self.condition.release()
+                if self.ring.put(value):
+                    pending += 1
+            if pending >= self._publish_every or eof_reached:
+                self.ring.publish()
+                pending = 0
 
             if eof_reached:
                 # Rewind CSV file if it is to be read in an infinite loop
-                if self.handle['repeatLoop']['value'] == 'true':
-                    # repeatLoop should not continue if thread has been signalled to stop
-                    if self._tstate_lock is None:
-                        return
-                    self.iter_sensor_data = iter(self.get_data())
+                if self._is_repeat:
+                    self._idx = 0
                     eof_reached = False
                 else:
                     return
 
 
 class Consumer(Thread):
-    def __init__(self, queue, cond, handle):
-        super(Consumer, self).__init__()
-        self.queue = queue
-        self.condition = cond
+    def __init__(self, ring, handle, stop_event):
+        super(Consumer, self).__init__(name='playback-consumer')
+        self.ring = ring
         self.handle = handle
+        self.stop_event = stop_event
+
+        self._is_historic = self.handle['historicTimestamps']['value'] == 'true'
+        self._ts_col = self.handle['timestampCol']['value']
+        self._ts_format = self.handle['timestampFormat']['value']
+        self._parse_ts = _timestamp_parser(self._ts_format)
+        self._asset_name = self.handle['assetName']['value']
 
     def run(self):
-        global wait_event
-        while True:
-            if wait_event.is_set():  # i.e. shutdown called
+        while not self.stop_event.is_set():
+            self.ring.published.acquire()
+            if self.stop_event.is_set():  # i.e. shutdown called
                 return
-            self.condition.acquire()
-            while self.queue.qsize() > 0:
-                data = self.queue.get()
+            batch = self.ring.drain()
+            if not batch:
+                continue
+            readings = []
+            for data in batch:
                 reading = data['data']
-                
-                if self.handle['historicTimestamps']['value'] == 'true':
-                    ts_col = self.handle['timestampCol']['value']
-                    raw_time_stamp = reading.pop(ts_col)
-                    ts_format = self.handle['timestampFormat']['value']
-                    time_stamp = str(datetime.datetime.strptime(raw_time_stamp, ts_format))
+
+                if self._is_historic:
+                    raw_time_stamp = reading.pop(self._ts_col)
+                    time_stamp = str(self._parse_ts(raw_time_stamp))
                 else:
                     time_stamp = data['ts']
 
-                reading = {
-                    'asset': self.handle['assetName']['value'],
+                readings.append({
+                    'asset': self._asset_name,
                     'timestamp': time_stamp,
                     'readings': reading
-                }
-                async_ingest.ingest_callback(c_callback, c_ingest_ref, reading)
-            self.condition.notify()
-            self.condition.release()
+                })
+            # Hand the whole drained batch to the south service in one ingest call
+            async_ingest.ingest_callback(c_callback, c_ingest_ref, readings)
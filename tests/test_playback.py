@@ -4,6 +4,9 @@
 # See: http://fledge-iot.readthedocs.io/
 # FLEDGE_END
 
+import datetime
+import threading
+import types
 import pytest
 
 from python.fledge.plugins.south.playback import playback
@@ -17,3 +20,237 @@ def test_plugin_contract():
     assert callable(getattr(playback, 'plugin_start'))
     assert callable(getattr(playback, 'plugin_shutdown'))
     assert callable(getattr(playback, 'plugin_reconfigure'))
+
+
+@pytest.mark.parametrize("value, is_int, is_float", [
+    ("42", True, False),
+    ("-7", True, False),
+    ("+4", True, False),
+    ("2.5", False, True),
+    (".5", False, True),
+    ("1e3", False, True),
+    ("-1.5E-2", False, True),
+    ("7a", False, False),
+    ("hello world", False, False),
+    ("", False, False),
+    ("1\u0663", False, False),
+    ("\u0661", False, False),
+    ("1.\u0665", False, False),
+])
+def test_numeric_value_patterns(value, is_int, is_float):
+    assert (playback._INT_RE.match(value) is not None) is is_int
+    assert (not is_int and playback._FLOAT_RE.match(value) is not None) is is_float
+
+
+def test_spsc_ring_publishes_in_batches_and_wraps():
+    ring = playback.SPSCRing(2, threading.Event())
+    assert ring.put(1) and ring.put(2)
+    assert ring.drain() == []
+    ring.publish()
+    assert ring.published.acquire(blocking=False)
+    assert ring.drain() == [1, 2]
+    ring.publish()
+    assert not ring.published.acquire(blocking=False)
+    assert ring.put(3)
+    ring.publish()
+    assert ring.drain() == [3]
+    assert ring.drain() == []
+
+
+def test_spsc_ring_put_blocks_until_drained():
+    ring = playback.SPSCRing(2, threading.Event())
+    assert ring.put(1) and ring.put(2)
+    results = []
+    producer = threading.Thread(target=lambda: results.append(ring.put(3)))
+    producer.start()
+    producer.join(timeout=0.2)
+    # The ring is full, so the producer published what it had and is now waiting for a free slot
+    assert producer.is_alive()
+    assert ring.drain() == [1, 2]
+    producer.join(timeout=5)
+    assert not producer.is_alive() and results == [True]
+    ring.publish()
+    assert ring.drain() == [3]
+
+
+def test_spsc_ring_put_gives_up_on_stop():
+    stop_event = threading.Event()
+    ring = playback.SPSCRing(1, stop_event)
+    assert ring.put(1)
+    results = []
+    producer = threading.Thread(target=lambda: results.append(ring.put(2)))
+    producer.start()
+    stop_event.set()
+    producer.join(timeout=5)
+    assert not producer.is_alive() and results == [False]
+
+
+@pytest.mark.parametrize("value, ts_format", [
+    ("2020-01-01 00:00:00.000", "%Y-%m-%d %H:%M:%S.%f"),
+    ("2021-12-31 23:59:59.5", "%Y-%m-%d %H:%M:%S.%f"),
+    ("2021-12-31T23:59:59.123456", "%Y-%m-%dT%H:%M:%S.%f"),
+    ("2021-06-15 08:30:00", "%Y-%m-%d %H:%M:%S"),
+    ("2021-6-5 8:30:00", "%Y-%m-%d %H:%M:%S"),
+    ("15/06/2021 08:30", "%d/%m/%Y %H:%M"),
+])
+def test_timestamp_parser_matches_strptime(value, ts_format):
+    assert playback._timestamp_parser(ts_format)(value) == datetime.datetime.strptime(value, ts_format)
+
+
+def test_timestamp_parser_rejects_invalid_values():
+    with pytest.raises(ValueError):
+        playback._timestamp_parser("%Y-%m-%d %H:%M:%S.%f")("2021-13-01 00:00:00.0")
+
+
+@pytest.mark.parametrize("first, second, ts_format", [
+    ("2020-01-01 00:00:00.000", "2020-01-01 00:00:00.250", "%Y-%m-%d %H:%M:%S.%f"),
+    ("2020-12-31 23:59:59.9", "2021-01-01 00:00:00.1", "%Y-%m-%d %H:%M:%S.%f"),
+    ("2020-02-28T12:00:00", "2020-03-01T12:00:30", "%Y-%m-%dT%H:%M:%S"),
+    ("28/02/2020 12:00", "01/03/2020 11:59", "%d/%m/%Y %H:%M"),
+    ("2020-01-01 10:00:00+0100", "2020-01-01 09:30:00+0000", "%Y-%m-%d %H:%M:%S%z"),
+])
+def test_timestamp_parser_differences_match_strptime(first, second, ts_format):
+    parse = playback._timestamp_parser(ts_format)
+    expected = datetime.datetime.strptime(second, ts_format) - datetime.datetime.strptime(first, ts_format)
+    assert (parse(second) - parse(first)).total_seconds() == expected.total_seconds()
+
+
+@pytest.mark.parametrize("value", ["2021-01-01 24:00:00.0", "2021-02-30 00:00:00.0", "not a time"])
+def test_timestamp_parser_rejects_out_of_range_values(value):
+    with pytest.raises(ValueError):
+        playback._timestamp_parser("%Y-%m-%d %H:%M:%S.%f")(value)
+
+
+def _handle(**values):
+    handle = {k: {'value': v['default']} for k, v in playback._DEFAULT_CONFIG.items()}
+    handle['csvFilename']['value'] = 'playback.csv'
+    for k, v in values.items():
+        handle[k]['value'] = v
+    return handle
+
+
+def _producer(tmp_path, monkeypatch, csv_text, **values):
+    monkeypatch.setattr(playback, '_FLEDGE_DATA', str(tmp_path))
+    (tmp_path / 'playback.csv').write_text(csv_text)
+    stop_event = threading.Event()
+    return playback.Producer(playback.SPSCRing(8, stop_event), _handle(**values), stop_event)
+
+
+_CSV = "ts, a ,b,c\n2020-01-01 00:00:00.000,1,2.5,x\n2020-01-01 00:00:00.300,-3,1e3,hello world\n" \
+       "2020-01-01 00:00:00.500,+4,.5,7a\n"
+
+
+def test_producer_loads_rows_once_and_coerces_values(tmp_path, monkeypatch):
+    producer = _producer(tmp_path, monkeypatch, _CSV)
+    # The file is no longer needed once loaded
+    (tmp_path / 'playback.csv').unlink()
+    assert producer._rows == [
+        {'ts': '2020-01-01 00:00:00.000', 'a': 1, 'b': 2.5, 'c': 'x'},
+        {'ts': '2020-01-01 00:00:00.300', 'a': -3, 'b': 1000.0, 'c': 'hello world'},
+        {'ts': '2020-01-01 00:00:00.500', 'a': 4, 'b': 0.5, 'c': '7a'},
+    ]
+
+
+def test_producer_rewinds_bursts_by_index(tmp_path, monkeypatch):
+    producer = _producer(tmp_path, monkeypatch, _CSV, ingestMode='burst', burstSize='3', readingCols='{"a": "a"}')
+    assert producer._next_burst() == [{'a': 1}, {'a': -3}, {'a': 4}]
+    producer._idx = 0
+    assert producer._next_burst() == [{'a': 1}, {'a': -3}, {'a': 4}]
+
+
+@pytest.mark.parametrize("historic, expected", [
+    ('false', [{'asset': 'sample', 'timestamp': 'now-1', 'readings': {'ts': '2020-01-01 00:00:00.000', 'a': 1}},
+               {'asset': 'sample', 'timestamp': 'now-2', 'readings': {'ts': '2020-01-01 00:00:00.300', 'a': -3}}]),
+    ('true', [{'asset': 'sample', 'timestamp': '2020-01-01 00:00:00', 'readings': {'a': 1}},
+              {'asset': 'sample', 'timestamp': '2020-01-01 00:00:00.300000', 'readings': {'a': -3}}]),
+])
+def test_consumer_ingests_each_drained_batch_in_one_call(monkeypatch, historic, expected):
+    calls = []
+    ingested = threading.Event()
+
+    def ingest_callback(callback, ingest_ref, readings):
+        calls.append(readings)
+        ingested.set()
+    monkeypatch.setattr(playback, 'async_ingest', types.SimpleNamespace(ingest_callback=ingest_callback))
+
+    stop_event = threading.Event()
+    ring = playback.SPSCRing(4, stop_event)
+    assert ring.put({'data': {'ts': '2020-01-01 00:00:00.000', 'a': 1}, 'ts': 'now-1'})
+    assert ring.put({'data': {'ts': '2020-01-01 00:00:00.300', 'a': -3}, 'ts': 'now-2'})
+    ring.publish()
+    consumer = playback.Consumer(ring, _handle(historicTimestamps=historic), stop_event)
+    consumer.start()
+    try:
+        assert ingested.wait(timeout=5)
+    finally:
+        stop_event.set()
+        ring.published.release()
+        consumer.join(timeout=5)
+    assert not consumer.is_alive()
+    assert calls == [expected]
+
+
+def test_producer_projects_reading_columns(tmp_path, monkeypatch):
+    producer = _producer(tmp_path, monkeypatch, _CSV, readingCols='{"a": "A", "c": "C", "missing": "M"}')
+    assert producer._rows == [{'A': 1, 'C': 'x'}, {'A': -3, 'C': 'hello world'}, {'A': 4, 'C': '7a'}]
+
+
+@pytest.mark.parametrize("repeat_loop", ['false', 'true'])
+def test_plugin_shutdown_stops_producer_and_consumer(tmp_path, monkeypatch, repeat_loop):
+    ingested = threading.Event()
+    monkeypatch.setattr(playback, 'async_ingest',
+                        types.SimpleNamespace(ingest_callback=lambda callback, ingest_ref, readings: ingested.set()))
+    monkeypatch.setattr(playback, 'utils', types.SimpleNamespace(local_timestamp=lambda: 'now'))
+    monkeypatch.setattr(playback, '_FLEDGE_DATA', str(tmp_path))
+    (tmp_path / 'playback.csv').write_text(_CSV)
+
+    handle = playback.plugin_init(_handle(sampleRate='1000', repeatLoop=repeat_loop))
+    playback.plugin_start(handle)
+    producer, consumer = playback.producer, playback.consumer
+    # Once the readings are in, the consumer is blocked waiting for the next batch
+    assert ingested.wait(timeout=5)
+    playback.plugin_shutdown(handle)
+    alive = [thread.name for thread in (producer, consumer) if thread.is_alive()]
+    # Don't leave a consumer stuck on the semaphore behind to hang the test run
+    consumer.ring.published.release()
+    assert alive == []
+    assert playback.producer is None and playback.consumer is None and playback.bucket is None
+
+
+def test_producer_bursts_end_with_a_partial_burst(tmp_path, monkeypatch):
+    producer = _producer(tmp_path, monkeypatch, _CSV, ingestMode='burst', burstSize='2', readingCols='{"a": "a"}')
+    assert producer._next_burst() == [{'a': 1}, {'a': -3}]
+    assert producer._next_burst() == [{'a': 4}]
+    assert producer._next_burst() == []
+
+
+@pytest.mark.parametrize("csv_text, values, field_names, rows", [
+    (_CSV, {}, ['ts', 'a', 'b', 'c'], 3),
+    ("1,x\n\n2,y\n", {'headerRow': 'false', 'fieldNames': 'p,q'}, ['p', 'q'], 2),
+    ("p,q\n1,x\n", {'headerRow': 'false'}, ['p', 'q'], 1),
+])
+def test_producer_reads_field_names_in_the_same_pass(tmp_path, monkeypatch, csv_text, values, field_names, rows):
+    producer = _producer(tmp_path, monkeypatch, csv_text, **values)
+    assert producer.field_names == field_names
+    assert len(producer._rows) == rows
+    assert all(list(row) == field_names for row in producer._rows)
+
+
+def test_producer_repeat_loop_waits_a_period_before_first_row_again(tmp_path, monkeypatch):
+    producer = _producer(tmp_path, monkeypatch, _CSV, timestampFromFile='true', sampleRate='10', repeatLoop='true')
+    delays = [next(producer.iter_sensor_data)[1] for _ in range(7)]
+    assert delays == [0, 0.3, 0.2, 0.1, 0.3, 0.2, 0.1]
+
+
+def test_producer_pairs_readings_with_file_timestamp_delays(tmp_path, monkeypatch):
+    producer = _producer(tmp_path, monkeypatch, _CSV, timestampFromFile='true', sampleRate='10')
+    pairs = list(producer.iter_sensor_data)
+    assert [readings for readings, _ in pairs] == [{'a': 1, 'b': 2.5, 'c': 'x'},
+                                                    {'a': -3, 'b': 1000.0, 'c': 'hello world'},
+                                                    {'a': 4, 'b': 0.5, 'c': '7a'}]
+    assert [delay for _, delay in pairs] == [0, 0.3, 0.2]
+
+
+def test_producer_pairs_readings_with_sample_period(tmp_path, monkeypatch):
+    producer = _producer(tmp_path, monkeypatch, _CSV, sampleRate='4')
+    assert [delay for _, delay in producer.iter_sensor_data] == [0.25, 0.25, 0.25]